@@ -1,14 +1,32 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import hashlib
+import mmap
 import os
 import os.path
 import re
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Sequence
+from queue import SimpleQueue
+from types import SimpleNamespace
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
+import httpx
 import requests
 import typer
 from e621.api import E621
@@ -16,12 +34,30 @@ from e621.enums import PoolCategory
 from e621.models import Pool, Post
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    # The e621 client parses every response through requests which uses the stdlib json.
+    # orjson parses large post lists several times faster. The patch is process-wide, so we only
+    # replace loads and keep the stdlib dumps that requests relies on when encoding request bodies.
+    requests.models.complexjson = SimpleNamespace(loads=orjson.loads, dumps=requests.models.complexjson.dumps)
+
 CURRENT_DIR = Path(__file__).parent
 USERNAME_FILE = CURRENT_DIR / "e621-dl_username.txt"
 API_KEY_FILE = CURRENT_DIR / "e621-dl_api_key.txt"
+CLEAN_STATE_FILE_NAME = ".e621dl_state"
 BYTES_IN_MB = 10**6
-VALID_FILE_NAME = re.compile(r"\d+ (?P<post_id>\d+)")
+CHUNK_SIZE = 1 << 16
+MMAP_MIN_FILE_SIZE = 1 << 23
+MAX_CONCURRENT_DOWNLOADS = 16
+DOWNLOAD_TIMEOUT = 30
+MAX_WALK_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+VALID_FILE_NAME = re.compile(r"^\d+ (?P<post_id>\d+)\.")
 INVALID_FILE_CHAR = re.compile(r'[<>:/\|?*"]+')
+# (post_id, is_symlink, path, size) of a post file found on disk. Size is None unless it was requested.
+PostFile = Tuple[int, bool, Path, Optional[int]]
 api = E621(
     (USERNAME_FILE.read_text(), API_KEY_FILE.read_text()) if USERNAME_FILE.exists() and API_KEY_FILE.exists() else None,
     timeout=180,
@@ -46,6 +82,17 @@ dir_arg: Path = typer.Option(
 save_space_arg = typer.Option(False, "-s", "--save-space", help="Save space by turning duplicates into symlinks")
 
 
+class DownloadError(typer.Exit):
+    """Raised after a mass download in which some of the files could not be downloaded
+
+    It is a typer.Exit so that the commands exit with a non-zero status once the failures have been reported.
+    """
+
+    def __init__(self, failed_urls: List[str]):
+        super().__init__(code=1)
+        self.failed_urls = failed_urls
+
+
 class PoolOrder(str, Enum):
     NAME = "name"
     CREATED_AT = "created_at"
@@ -87,7 +134,7 @@ def search_posts(
                 optimized_posts += 1
                 dst = directory / get_post_name(index, post.id, post.file.ext)
                 if not dst.is_file():
-                    shutil.copyfile(post_managers[post.id].copies[0], dst)
+                    fast_copy(post_managers[post.id].copies[0], dst)
         print(optimized_posts, "posts already downloaded")
     mass_enumerated_download(posts, directory, api)
 
@@ -181,8 +228,13 @@ def clean(
         dirs = [Path.cwd()]
     post_managers: Dict[int, PostManager] = {}
     for d in dirs:
-        find_all_posts(d, post_managers)
-    ids_to_download: List[tuple[str, Path]] = []
+        find_all_posts(d, post_managers, with_sizes=True)
+    state_files = [d / CLEAN_STATE_FILE_NAME for d in dirs]
+    state = get_clean_state(dirs, post_managers, download_broken_symlinks)
+    if all(f.is_file() and f.read_text() == state for f in state_files):
+        print("Nothing changed since the last clean")
+        return
+    paths_by_id: Dict[int, Path] = {}
     for post in post_managers.values():
         if not post.copies:
             if download_broken_symlinks:
@@ -191,16 +243,33 @@ def clean(
                 post.copies.append(new_original_path)
                 # Pathlib has a weird error where we can't overwrite a broken symlink
                 new_original_path.unlink()
-                ids_to_download.append((str(post.id), new_original_path))
+                paths_by_id[post.id] = new_original_path
         post.replace_copies_with_symlinks()
-    posts = api.posts.get([int(id) for id, _ in ids_to_download])
-    zipped_posts = zip(sorted(ids_to_download, key=lambda p: p[0]), sorted(posts, key=lambda p: p.id))
-    posts_to_download = [
-        (post.file.url, path, post.file.size)
-        for ((_, path), post) in zipped_posts
+    posts = api.posts.get(list(paths_by_id))
+    posts_to_download = (
+        (post.file.url, paths_by_id[post.id], post.file.size)
+        for post in posts
         if post.file is not None and post.file.url is not None
-    ]
-    mass_download(posts_to_download, api, overwrite=True)
+    )
+    download_error: Optional[DownloadError] = None
+    try:
+        mass_download(posts_to_download, api, overwrite=True)
+    except DownloadError as e:
+        download_error = e
+
+    # The managers already reflect the cleaned tree, except for the sizes of re-downloaded posts
+    for post_id, path in paths_by_id.items():
+        try:
+            post_managers[post_id].sizes[path] = path.stat().st_size
+        except FileNotFoundError:
+            # The post could not be downloaded, so the next clean has to try again
+            break
+    else:
+        state = get_clean_state(dirs, post_managers, download_broken_symlinks)
+        for f in state_files:
+            f.write_text(state)
+    if download_error is not None:
+        raise download_error
 
 
 @app.command()
@@ -236,25 +305,154 @@ def mass_download(
     api: E621,
     overwrite: bool = False,
 ) -> None:
-    with requests.Session() as session:
-        session.headers.update({"User-Agent": "e6tools"})
-        session.auth = api.session.auth
-        total_size = sum(size for _, _, size in files)
-        progress_bar = tqdm(total=total_size, unit="iB", unit_scale=True)
+    # files may be a single-pass iterable, so we materialize it before taking the total size
+    files = list(files)
+    total_size = sum(size for _, _, size in files)
+    progress_bar = tqdm(total=total_size, unit="iB", unit_scale=True)
+    if not overwrite:
+        # One directory listing per target directory instead of one stat per file
+        existing_names = {d: list_file_names(d) for d in {path.parent for _, path, _ in files}}
+        missing_files = []
         for url, path, size in files:
-            progress_bar.set_description(f"Downloading {path.name}")
-            if not path.exists() or overwrite:
-                download_file(url, path, timeout=30)
-            progress_bar.update(size)
-
+            if path.name in existing_names[path.parent]:
+                progress_bar.update(size)
+            else:
+                missing_files.append((url, path, size))
+        files = missing_files
+    # Duplicate posts can share a file, so each url is downloaded once and copied to the rest of its paths
+    targets: Dict[str, List[Tuple[Path, int]]] = {}
+    for url, path, size in files:
+        targets.setdefault(url, []).append((path, size))
+    failures = asyncio.run(_download_all(targets, api.session.auth, progress_bar))
+    if failures:
+        for url, error in failures:
+            print(f"Failed to download {url}: {error!r}")
+        print(f"Failed to download {len(failures)} files")
+        raise DownloadError([url for url, _ in failures])
+
+
+def list_file_names(d: Path) -> Set[str]:
+    try:
+        with os.scandir(d) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+
+async def _download_all(
+    targets: Dict[str, List[Tuple[Path, int]]],
+    auth: Optional[Tuple[str, str]],
+    progress_bar: tqdm,
+) -> List[Tuple[str, Exception]]:
+    """Download every url once, concurrently over a single connection pool, and copy it to all of its paths
+
+    A failed url does not stop the others. Returns the failed urls with their errors.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    # HTTP/2 lets all concurrent downloads from the e621 CDN share a single connection
+    async with httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=8, max_connections=MAX_CONCURRENT_DOWNLOADS),
+        headers={"User-Agent": "e6tools"},
+        auth=auth,
+        timeout=DOWNLOAD_TIMEOUT,
+        follow_redirects=True,
+    ) as client:
+
+        async def download(url: str, paths: List[Tuple[Path, int]]) -> None:
+            (path, _), *copies = paths
+            async with semaphore:
+                progress_bar.set_description(f"Downloading {path.name}")
+                await download_file_async(url, path, client, progress_bar)
+            loop = asyncio.get_running_loop()
+            for copy, size in copies:
+                # Falling back to a full copy can take a while for large files, so it must not block other downloads
+                await loop.run_in_executor(None, fast_copy, path, copy)
+                progress_bar.update(size)
+
+        results = await asyncio.gather(
+            *(download(url, paths) for url, paths in targets.items()),
+            return_exceptions=True,
+        )
+    return [(url, result) for url, result in zip(targets, results) if isinstance(result, Exception)]
+
+
+async def download_file_async(
+    url: str,
+    path: Path,
+    client: httpx.AsyncClient,
+    progress_bar: Optional[tqdm] = None,
+) -> None:
+    # The body is written to a hidden sibling file and only moved to path once it is complete,
+    # so an interrupted download never looks like an already downloaded post
+    part = path.with_name(f".{path.name}.part")
+    try:
+        async with client.stream("GET", url) as r:
+            r.raise_for_status()
+            size = r.headers.get("Content-Length")
+            # Content-Length is only the size of the file on disk when the body is not compressed
+            if size is not None and int(size) >= MMAP_MIN_FILE_SIZE and "Content-Encoding" not in r.headers:
+                received = await _write_mmapped(r.aiter_bytes(CHUNK_SIZE), part, int(size), progress_bar)
+                if received != int(size):
+                    raise httpx.RemoteProtocolError(f"Received {received} of {size} bytes", request=r.request)
+            else:
+                with part.open("wb") as f:
+                    async for chunk in r.aiter_bytes(CHUNK_SIZE):
+                        f.write(chunk)
+                        if progress_bar is not None:
+                            progress_bar.update(len(chunk))
+        os.replace(part, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            part.unlink()
+        raise
+
+
+async def _write_mmapped(
+    chunks: AsyncIterator[bytes],
+    path: Path,
+    size: int,
+    progress_bar: Optional[tqdm] = None,
+) -> int:
+    """Write a large response body into a preallocated memory map of the destination file
 
-def download_file(url: str, path: Path, session: Optional[requests.Session] = None, **kwargs) -> requests.Response:
-    if session is None:
-        r = requests.get(url, **kwargs)
-    else:
-        r = session.get(url, **kwargs)
-    path.write_bytes(r.content)
-    return r
+    Returns:
+        The number of bytes received
+    """
+    with path.open("w+b") as f:
+        f.truncate(size)
+        offset = 0
+        with mmap.mmap(f.fileno(), size) as mm:
+            async for chunk in chunks:
+                end = offset + len(chunk)
+                mm[offset:end] = chunk
+                offset = end
+                if progress_bar is not None:
+                    progress_bar.update(len(chunk))
+    return offset
+
+
+def fast_copy(src: Path, dst: Path) -> None:
+    """Copy src to dst using the cheapest method the filesystem supports
+
+    Tries a hardlink first, then an in-kernel copy (which becomes a reflink on btrfs/XFS),
+    and finally falls back to a regular userspace copy.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is not None:
+        try:
+            with src.open("rb") as fsrc, dst.open("wb") as fdst:
+                while copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
 
 
 def get_post_name(i: int, post_id: int, post_extension: str) -> str:
@@ -266,56 +464,148 @@ class PostManager:
         self.id = id
         self.copies: List[Path] = []
         self.links: List[Path] = []
+        self.sizes: Dict[Path, int] = {}
 
     def replace_copies_with_symlinks(self):
         # We use shortest path as the original because it will be more likely to contain the original artist tag
         original = find_shortest_path(self.copies)
         self.copies.remove(original)
-        for copy in self.copies + self.links:
-            copy.unlink()
-            copy.symlink_to(os.path.relpath(original, copy.parent))
+        original_path = os.fspath(original.absolute())
+        relpaths: Dict[Path, str] = {}
+        links = self.copies + self.links
+        for copy in links:
+            parent = copy.parent
+            if parent not in relpaths:
+                relpaths[parent] = os.path.relpath(original_path, os.fspath(parent.absolute()))
+            copy_path = os.fspath(copy)
+            os.unlink(copy_path)
+            os.symlink(relpaths[parent], copy_path)
+            # The size of a symlink is the length of its target
+            self.sizes[copy] = len(os.fsencode(relpaths[parent]))
+        self.copies = [original]
+        self.links = links
+
+
+def find_all_posts(d: Path, posts: Dict[int, PostManager], with_sizes: bool = False):
+    for post_id, is_symlink, path, size in iter_posts(d, with_sizes):
+        if post_id not in posts:
+            post = PostManager(post_id)
+            posts[post_id] = post
+        else:
+            post = posts[post_id]
+        if is_symlink:
+            post.links.append(path)
+        else:
+            post.copies.append(path)
+        if size is not None:
+            post.sizes[path] = size
 
 
-def find_all_posts(d: Path, posts: Dict[int, PostManager]):
-    for file_or_dir in d.iterdir():
-        if file_or_dir.is_dir():
-            find_all_posts(file_or_dir, posts)
-        else:
-            file = file_or_dir
-            m = VALID_FILE_NAME.match(file.name)
-            if m is None:
-                continue
-            post_id = int(m["post_id"])
-            if post_id not in posts:
-                post = PostManager(post_id)
-                posts[post_id] = post
+def iter_posts(d: Path, with_sizes: bool = False) -> Iterator[PostFile]:
+    """Yield (post_id, is_symlink, path, size) for every post file in d, walking its subdirectories in parallel
+
+    Sizes cost an extra lstat per file, so they are only collected when with_sizes is set.
+    """
+    subdirs, files = _scan_dir(d)
+    yield from _parse_post_files(files, with_sizes)
+    if not subdirs:
+        return
+    # Workers send one batch per directory and None when their subtree is done
+    batches: SimpleQueue[Optional[List[PostFile]]] = SimpleQueue()
+
+    def walk(subdir: Path) -> None:
+        try:
+            for batch in _walk_post_batches(subdir, with_sizes):
+                batches.put(batch)
+        finally:
+            batches.put(None)
+
+    with ThreadPoolExecutor(max_workers=MAX_WALK_WORKERS) as executor:
+        futures = [executor.submit(walk, subdir) for subdir in subdirs]
+        unfinished_walks = len(futures)
+        while unfinished_walks:
+            batch = batches.get()
+            if batch is None:
+                unfinished_walks -= 1
             else:
-                post = posts[post_id]
-            if file.is_symlink():
-                post.links.append(file)
+                yield from batch
+        for future in futures:
+            future.result()
+
+
+def _walk_post_batches(d: Path, with_sizes: bool) -> Iterator[List[PostFile]]:
+    # An explicit stack avoids a Python frame and a chain of nested generators per directory
+    stack = [d]
+    while stack:
+        subdirs, files = _scan_dir(stack.pop())
+        yield _parse_post_files(files, with_sizes)
+        stack.extend(reversed(subdirs))
+
+
+def _scan_dir(d: Path) -> Tuple[List[Path], List[os.DirEntry]]:
+    subdirs: List[Path] = []
+    files: List[os.DirEntry] = []
+    with os.scandir(d) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(Path(entry.path))
             else:
-                post.copies.append(file)
+                files.append(entry)
+    return subdirs, files
 
 
-def find_shortest_path(paths: List[Path]) -> Path:
-    return min(paths, key=lambda p: len(str(p.absolute())))
+def _parse_post_files(files: Iterable[os.DirEntry], with_sizes: bool) -> List[PostFile]:
+    match = VALID_FILE_NAME.match
+    post_files: List[PostFile] = []
+    for entry in files:
+        name = entry.name
+        # Rejects most unrelated files without calling into the regex engine
+        if not name[:1].isdigit():
+            continue
+        m = match(name)
+        if m is not None:
+            size = entry.stat(follow_symlinks=False).st_size if with_sizes else None
+            post_files.append((int(m["post_id"]), entry.is_symlink(), Path(entry.path), size))
+    return post_files
 
 
-def sort_tag(tag: str) -> int:
-    code = int.from_bytes(tag.encode(), "little", signed=False)
-    if ":" in tag or tag.startswith("-"):
-        # Meaning that we want it to be at the end.
-        # The method used is so complex because we want each integer to be unique
-        # so that the original order of elements does not matter.
-        return -code
-    else:
-        return code
+def get_clean_state(dirs: List[Path], posts: Dict[int, PostManager], download_broken_symlinks: bool) -> str:
+    """Computes a digest of every post file that clean would touch
+
+    If the digest matches the one saved by the previous clean, there is nothing left to clean.
+    """
+    state = hashlib.sha1()
+    state.update(repr((sorted(os.fspath(d.absolute()) for d in dirs), download_broken_symlinks)).encode())
+    for post_id in sorted(posts):
+        post = posts[post_id]
+        for kind, paths in (("copy", post.copies), ("link", post.links)):
+            for path in sorted(paths):
+                state.update(f"{post_id}\0{kind}\0{path}\0{post.sizes[path]}\n".encode())
+    return state.hexdigest()
+
+
+def find_shortest_path(paths: List[Path]) -> Path:
+    # Library files all sit at the same depth, so the shortest path is what actually picks the shortest tag directory.
+    # The path itself breaks the remaining ties deterministically.
+    return min(paths, key=lambda p: (len(p.parts), len(os.fspath(p)), os.fspath(p)))
 
 
 def normalize_tags(tags: List[str]) -> List[str]:
     tags = [t.lower().strip() for t in tags]
-    tags.sort(reverse=True, key=sort_tag)
-    return tags
+    # Metatags and negated tags go to the end. The order must stay stable because it names the download directory.
+    plain_tags = sorted((t for t in tags if not is_special_tag(t)), key=tag_order, reverse=True)
+    special_tags = sorted((t for t in tags if is_special_tag(t)), key=tag_order)
+    return plain_tags + special_tags
+
+
+def is_special_tag(tag: str) -> bool:
+    return ":" in tag or tag.startswith("-")
+
+
+def tag_order(tag: str) -> Tuple[int, bytes]:
+    # Same order as comparing the UTF-8 bytes of tags as little-endian integers, without building the integers
+    code = tag.encode()
+    return len(code), code[::-1]
 
 
 def normalize_file_name(name: str, id: int) -> str: